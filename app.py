@@ -3,8 +3,27 @@
 
 import dash
 import dash_bootstrap_components as dbc
+from flask import request
+from flask_compress import Compress
+
+from payload import payload_budget, payload_size_message
 
 app = dash.Dash(__name__,
                 external_stylesheets=[dbc.themes.BOOTSTRAP],
                 meta_tags=[{"name": "viewport", "content": "width=device-width"}],
                 suppress_callback_exceptions=True)
+
+# Compress callback responses, layout and assets, preferring brotli where the browser supports it
+app.server.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+Compress(app.server)
+
+# Log callback responses over the payload budget. Registered after Compress, so Flask runs
+# it first and it sees the uncompressed size
+@app.server.after_request
+def log_oversized_response(response):
+    if request.path.endswith("_dash-update-component") and not response.direct_passthrough:
+        size = response.calculate_content_length() or 0
+        if size > payload_budget:
+            outputs = (request.get_json(silent=True) or {}).get("output")
+            print(payload_size_message(f"Callback response for {outputs}", size))
+    return response
@@ -0,0 +1,65 @@
+import duckdb
+
+# Build the Hive-partitioned Parquet dataset served by pages/page1.py:
+#   ddg_info/parquet/pdb=XYZ/part-0.parquet
+# Queries filter on the gene's pdb list, so they only open those structures' files. The
+# dataset does not depend on the gene_pdbs mapping, so a new mapping can be published
+# without rebuilding it. Within a structure the rows are sorted so the Parquet min/max
+# statistics let DuckDB skip row groups that cannot hold the selected residue/mutation.
+#
+# The app will not start without this dataset and the raw CSVs are not copied into the
+# Docker image, so run this (python create_parquet.py) before building the image.
+csv_files = [
+    'ddg_info/ddg_info1.csv',
+    'ddg_info/ddg_info2.csv',
+    'ddg_info/ddg_info3.csv',
+    'ddg_info/ddg_info4.csv',
+    'ddg_info/ddg_info5.csv',
+    'ddg_info/ddg_info6.csv',
+    'ddg_info/ddg_info7.csv',
+    'ddg_info/ddg_info8.csv',
+    'ddg_info/ddg_info9a.csv',
+    'ddg_info/ddg_info9b.csv',
+    'ddg_info/ddg_info10.csv',
+]
+duckdb_con = duckdb.connect(':memory:')
+duckdb_con.execute("PRAGMA temp_directory='ddg_info/tmp'")
+
+union_query = " UNION ALL ".join([f"SELECT * FROM read_csv_auto('{csv}')" for csv in csv_files])
+duckdb_con.execute(f"CREATE VIEW ddg_info AS {union_query}")
+
+duckdb_con.execute("""
+    COPY (
+        -- Residues are stored as text so they compare with the residue bound by page1
+        SELECT * REPLACE (CAST(pdb_residual AS VARCHAR) AS pdb_residual)
+        FROM ddg_info
+        ORDER BY pdb, pdb_residual, mut_from, mut_to
+    )
+    TO 'ddg_info/parquet'
+    (FORMAT PARQUET, PARTITION_BY (pdb), FILENAME_PATTERN 'part-{i}', ROW_GROUP_SIZE 100000, OVERWRITE_OR_IGNORE)
+""")
+
+# Per-PDB ΔΔG histograms, used as mergeable quantile sketches for approximate percentiles.
+# Bins 1-1000 split -10..100 kcal/mol into 0.11 kcal/mol steps (the gene histogram bins in
+# pages/page1.py), bin 0 counts values below -10 and bin 1001 values of 100 and above.
+# Stored in long form so only non-empty bins take space.
+duckdb_con.execute("""
+    COPY (
+        SELECT
+            pdb,
+            CASE
+                WHEN ddg < -10 THEN 0
+                WHEN ddg >= 100 THEN 1001
+                ELSE LEAST(CAST(floor((ddg + 10) / 0.11) AS INTEGER), 999) + 1
+            END AS bin,
+            count(*) AS n
+        FROM ddg_info
+        WHERE ddg IS NOT NULL
+        GROUP BY ALL
+        ORDER BY pdb, bin
+    )
+    TO 'ddg_info/pdb_sketches.parquet'
+    (FORMAT PARQUET)
+""")
+
+duckdb_con.close()
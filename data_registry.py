@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+# Data version registry. A manifest records the path and sha256 of every data file the app
+# reads. publish_data.py copies files into immutable data/objects/<hash>/ directories and
+# then replaces the manifest in a single rename. Workers poll the manifest, load a changed
+# version in the background and swap it in atomically, so new ΔΔG results are served
+# without rebuilding the image or restarting workers
+manifest_file = os.environ.get("data_manifest", default="data/manifest.json")
+check_seconds = float(os.environ.get("data_check_seconds", default="10"))
+
+# Files read when there is no manifest, as shipped in the image
+local_files = {
+    "gene_pdbs": "gene_pdbs",
+    "pdb_residual": "pdb_residual",
+    "mutfrom_options": "dropdown_pdb_mut_from.csv",
+    "mutto_options": "dropdown_pdb_mut_from_to.csv",
+    "ddg_info": "ddg_info/parquet",
+    "pdb_sketches": "ddg_info/pdb_sketches.parquet",
+}
+
+
+# sha256 of a file, or of every file in a directory in sorted relative-path order
+def file_hash(path):
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode())
+                digest.update(file_hash(file_path).encode())
+    else:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+# Everything the pages read from one version of the data files. Anything derived from the
+# data lives here too, so swapping snapshots invalidates it along with the data
+class DataSnapshot:
+
+    def __init__(self, version, files):
+        self.version = version
+
+        # Load static data files
+        self.gene_pdbs = pd.read_csv(files["gene_pdbs"])
+        self.pdb_residual = pd.read_csv(files["pdb_residual"])
+        self.mutfrom_options = pd.read_csv(files["mutfrom_options"], dtype=str)
+        self.mutto_options = pd.read_csv(files["mutto_options"], dtype=str)
+
+        # Create in-memory DuckDB connection that queries the Parquet dataset directly
+        self.duckdb_con = duckdb.connect(':memory:')
+
+        # Hive-partitioned by pdb (built by create_parquet.py). Filtering on a gene's pdb list prunes
+        # the scan to those files, so memory per request is bounded by the gene, not the dataset
+        if not os.path.isdir(files["ddg_info"]):
+            raise FileNotFoundError(f"{files['ddg_info']} not found, build it with create_parquet.py")
+        self.duckdb_con.execute(f"""
+            CREATE VIEW ddg_info AS
+            SELECT * FROM read_parquet('{files["ddg_info"]}/*/*.parquet',
+                                       hive_partitioning = true, hive_types = {{'pdb': VARCHAR}})
+        """)
+
+        # Set memory limits to prevent OOM
+        self.duckdb_con.execute("PRAGMA memory_limit='256MB'")
+        self.duckdb_con.execute("PRAGMA threads=1")
+
+        # Per-PDB ΔΔG histograms (built by create_parquet.py). A gene's histogram is the sum of its
+        # structures' rows, so changing the structure filters re-aggregates a few hundred small
+        # arrays instead of rescanning ΔΔG rows
+        sketch_file = files.get("pdb_sketches")
+        self.sketches_loaded = sketch_file is not None and os.path.exists(sketch_file)
+        if self.sketches_loaded:
+            sketch = self.duckdb_con.execute(f"SELECT pdb, bin, n FROM read_parquet('{sketch_file}')").fetchnumpy()
+            sketch_pdbs, sketch_rows = np.unique(sketch['pdb'], return_inverse=True)
+            self.pdb_sketches = np.zeros((len(sketch_pdbs), 1002), dtype=np.int64)
+            np.add.at(self.pdb_sketches, (sketch_rows, sketch['bin']), sketch['n'])
+            self.pdb_sketch_rows = {pdb: row for row, pdb in enumerate(sketch_pdbs)}
+
+        # Sorted search indexes for the gene and residue dropdowns
+        self.gene_index = sorted(self.gene_pdbs['name_of_gene'].dropna().unique(), key=str.upper)
+        self.gene_index_keys = [gene.upper() for gene in self.gene_index]
+        self.residue_index = {
+            gene: sorted(set(self.pdb_residual[gene].dropna().astype(int).tolist()))
+            for gene in self.pdb_residual.columns
+        }
+
+        # Experimental methods offered by the structure filter
+        self.exp_method_options = sorted(self.gene_pdbs['exp_method'].dropna().unique())
+
+    # Requests hold the snapshot they started with, so a swapped-out snapshot is freed once the
+    # last of them finishes. Close its connection then, releasing DuckDB's memory straight away
+    def __del__(self):
+        duckdb_con = getattr(self, "duckdb_con", None)
+        if duckdb_con is not None:
+            duckdb_con.close()
+
+
+# Load the version named by the manifest. publish_data.py hashes each file once and stores it
+# under objects/<sha256>/, which is never modified, so workers only check that each path sits
+# under its recorded hash and exists rather than re-reading the whole dataset
+def load_manifest():
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    root = os.path.dirname(manifest_file)
+    files = {}
+    for name, entry in manifest["files"].items():
+        path = os.path.join(root, entry["path"])
+        if os.path.basename(os.path.dirname(path)) != entry["sha256"]:
+            raise ValueError(f"{path} is not stored under its sha256 in {manifest_file}")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} named in {manifest_file} does not exist")
+        files[name] = path
+    return DataSnapshot(manifest["version"], files)
+
+
+def manifest_stamp():
+    try:
+        return os.stat(manifest_file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+snapshot = None
+loaded_stamp = None
+next_check = 0
+reload_lock = threading.Lock()
+
+
+# Runs in a background thread while requests keep being served from the old snapshot. Until
+# those requests finish, the old and new snapshots, and their DuckDB connections, both exist
+def reload(stamp):
+    global snapshot, loaded_stamp
+    try:
+        new_snapshot = load_manifest()
+        snapshot = new_snapshot
+        print(f"Swapped to data version {new_snapshot.version}")
+    except Exception as error:
+        print(f"Keeping data version {snapshot.version}, could not load {manifest_file}: {error}")
+    finally:
+        # Also recorded on failure, so a broken manifest is not reloaded on every check
+        loaded_stamp = stamp
+        reload_lock.release()
+
+
+# The snapshot to serve a request from. Callbacks should call this once and use the result
+# throughout, so every step of a request sees the same version. At most one reload runs at
+# a time and nobody waits for it, so a new version never causes a stampede of cold loads
+def current():
+    global snapshot, loaded_stamp, next_check
+    if snapshot is None:
+        with reload_lock:
+            if snapshot is None:
+                loaded_stamp = manifest_stamp()
+                snapshot = load_manifest() if loaded_stamp is not None else DataSnapshot("local", local_files)
+        return snapshot
+
+    now = time.monotonic()
+    if now >= next_check:
+        next_check = now + check_seconds
+        stamp = manifest_stamp()
+        if stamp != loaded_stamp and reload_lock.acquire(blocking=False):
+            threading.Thread(target=reload, args=(stamp,), daemon=True).start()
+    return snapshot
@@ -1,40 +1,48 @@
+import contextvars
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Import necessary libraries
 from dash import html, dcc
-from dash.dependencies import Input, Output
-import plotly.express as px
+from dash.dependencies import Input, Output, State
 
 # Connect to main app.py file
 from app import app
+from profiling import profiled, profile_thread, token_valid
+import data_registry
 
 # Connect to your app pages
-from pages import page1
+from pages import page1, admin
 
 # Connect the navbar to the index
 from components import navbar
 
-# Define default graphs so they appear consistent whether empty of with data plotted
-empty_gene_histogram = px.histogram(
-    [],
-    range_x=[-10, 100],
-    nbins=1000,
-    title=f'Histogram of ΔΔG values for selected gene',
-    template="plotly_white",
-)
-empty_gene_histogram.update_yaxes(showticklabels=False, title="Frequency")
-empty_gene_histogram.update_xaxes(showgrid=False, title="ΔΔG (kcal/mol)")
-
-empty_variant_histogram = px.histogram(
-    [],
-    range_x=[-10, 100],
-    nbins=20,
-    title='Histogram of ΔΔG values for selected variant',
-    labels={'x': 'ΔΔG (kcal/mol)', 'y': 'Frequency'},
-    template="plotly_white",
-)
-empty_variant_histogram.update_yaxes(showticklabels=False, title="Frequency")
-empty_variant_histogram.update_xaxes(showgrid=False, title="ΔΔG (kcal/mol)")
+# Define default graphs so they appear consistent whether empty of with data plotted.
+# Callbacks patch data into these, so they must be sent in full whenever a selection is cleared
+empty_gene_histogram = page1.empty_gene_histogram
+empty_variant_histogram = page1.empty_variant_histogram
+
+
+# Thread pool for independent DuckDB queries within a callback. DuckDB releases the GIL while
+# a query runs, so two queries on the pool take as long as the slower one, not their sum
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get("callback_threads", default="4")))
+
+# Run fn and record how long it took under name in timings
+def timed(timings, name, fn, *args):
+    start = time.perf_counter()
+    with profile_thread():
+        result = fn(*args)
+    timings[name] = time.perf_counter() - start
+    return result
+
+# Run a timed step on the pool, in the caller's context so a profiled callback samples it
+def submit(timings, name, fn, *args):
+    return executor.submit(contextvars.copy_context().run, timed, timings, name, fn, *args)
+
+
+# Load the data before serving so the first request does not pay for it
+data_registry.current()
 
 
 # Define the navbar
@@ -50,13 +58,30 @@ app.layout = html.Div([
     html.Div(id='page-content', children=[]),
 ])
 
+# The gene and residue dropdowns are searched server side, returning only the top matches
+@app.callback(
+    Output(component_id = "gene_selected", component_property = "options"),
+    Input(component_id = "gene_selected", component_property = "search_value"),
+    State(component_id = "gene_selected", component_property = "value"),
+    prevent_initial_call=True,
+)
+@profiled
+def update_dropdown_gene(search_value, gene_selected):
+    data = data_registry.current()
+    dropdownlist = page1.set_dropdown_options_gene(data, search_value, gene_selected)
+    return dropdownlist
+
 @app.callback(
     Output(component_id = "residual_selected", component_property = "options"),
-    Input('gene_selected', 'value'),
+    [Input(component_id = "gene_selected", component_property = "value"),
+     Input(component_id = "residual_selected", component_property = "search_value")],
+    State(component_id = "residual_selected", component_property = "value"),
     prevent_initial_call=True,
 )
-def update_dropdown_page1_2a(gene_selected):
-    dropdownlist = page1.set_dropdown_options_page1_2a(gene_selected)
+@profiled
+def update_dropdown_page1_2a(gene_selected, search_value, residual_selected):
+    data = data_registry.current()
+    dropdownlist = page1.set_dropdown_options_page1_2a(data, gene_selected, search_value, residual_selected)
     return dropdownlist
 
 @app.callback(
@@ -65,8 +90,10 @@ def update_dropdown_page1_2a(gene_selected):
      Input(component_id = "residual_selected", component_property = "value")],
     prevent_initial_call=True,
 )
+@profiled
 def update_dropdown_page1_2b(gene_selected, residual_selected):
-    dropdownlist = page1.set_dropdown_options_page1_2b(gene_selected, residual_selected)
+    data = data_registry.current()
+    dropdownlist = page1.set_dropdown_options_page1_2b(data, gene_selected, residual_selected)
     return dropdownlist
 
 
@@ -77,8 +104,10 @@ def update_dropdown_page1_2b(gene_selected, residual_selected):
      Input(component_id = "mutfrom_selected", component_property = "value")],
     prevent_initial_call=True,
 )
+@profiled
 def update_dropdown_page1_2c(gene_selected, residual_selected, mutfrom_selected):
-    dropdownlist = page1.set_dropdown_options_page1_2c(gene_selected, residual_selected, mutfrom_selected)
+    data = data_registry.current()
+    dropdownlist = page1.set_dropdown_options_page1_2c(data, gene_selected, residual_selected, mutfrom_selected)
     return dropdownlist
 
 
@@ -89,9 +118,14 @@ def update_dropdown_page1_2c(gene_selected, residual_selected, mutfrom_selected)
     [Input(component_id = "gene_selected", component_property = "value"),
      Input(component_id = "residual_selected", component_property = "value"),
      Input(component_id = "mutfrom_selected", component_property = "value"),
-     Input(component_id = "mutto_selected", component_property = "value")],
+     Input(component_id = "mutto_selected", component_property = "value"),
+     Input(component_id = "exp_method_selected", component_property = "value"),
+     Input(component_id = "min_coverage", component_property = "value"),
+     Input(component_id = "min_length", component_property = "value")],
 )
-def update_graphs_and_markdown(gene_selected, residual_selected, mutfrom_selected, mutto_selected):
+@profiled
+def update_graphs_and_markdown(gene_selected, residual_selected, mutfrom_selected, mutto_selected,
+                               exp_method_selected, min_coverage, min_length):
     if None in {mutto_selected, gene_selected, residual_selected, mutfrom_selected}:
         return [
             empty_gene_histogram,
@@ -99,23 +133,68 @@ def update_graphs_and_markdown(gene_selected, residual_selected, mutfrom_selecte
             "",
         ]
 
-    gene_pdbs = page1.gene_pdbs
-    pdb_values = page1.get_pdb_values(gene_pdbs, gene_selected)
-    median_ddg = page1.calculate_median(pdb_values,residual_selected, mutfrom_selected, mutto_selected)
-    percentile = page1.calculate_percentile(pdb_values, residual_selected, mutfrom_selected, mutto_selected)
+    start = time.perf_counter()
+    timings = {}
 
-    gene_figure = page1.ddg_for_gene_plot(gene_selected, pdb_values, median_ddg)
-    variant_figure = page1.ddg_for_variant_plot(pdb_values, residual_selected, mutfrom_selected, mutto_selected)
+    # One data version for the whole request, even if a new one is swapped in meanwhile
+    data = data_registry.current()
+    approx_percentile = page1.approx_percentile and data.sketches_loaded
+
+    pdb_values = page1.get_pdb_values(data, gene_selected, exp_method_selected, min_coverage, min_length)
+    if not pdb_values:
+        return [
+            empty_gene_histogram,
+            empty_variant_histogram,
+            f"No structures of {gene_selected} match the selected filters.",
+        ]
+
+    # With sketches the gene histogram is a sum of per-PDB rows. Without them it needs its own
+    # query, which is independent of the variant's, so that one runs on the pool alongside it
+    if data.sketches_loaded:
+        gene_sketch = timed(timings, "gene_sketch", page1.get_gene_sketch, data, pdb_values)
+        gene_counts = gene_sketch[1:-1]
+    else:
+        gene_future = submit(timings, "gene_histogram", page1.get_gene_histogram, data, pdb_values)
+
+    variant_ddg = timed(timings, "variant_query", page1.get_variant_ddg,
+                        data, pdb_values, residual_selected, mutfrom_selected, mutto_selected)
+    if variant_ddg.empty:
+        return [
+            empty_gene_histogram,
+            empty_variant_histogram,
+            f"No ΔΔG values for this variant of {gene_selected} in the selected structures.",
+        ]
+    median_ddg = page1.calculate_median(variant_ddg)
+    variant_figure = timed(timings, "variant_figure", page1.ddg_for_variant_plot, variant_ddg)
+
+    if approx_percentile:
+        percentile = timed(timings, "percentile", page1.calculate_approx_percentile, gene_sketch, median_ddg)
+    else:
+        percentile = timed(timings, "percentile", page1.calculate_percentile,
+                           data, pdb_values, median_ddg)
+
+    if not data.sketches_loaded:
+        gene_counts = gene_future.result()
+
+    gene_figure = timed(timings, "gene_figure", page1.ddg_for_gene_plot, gene_selected, gene_counts, median_ddg)
     text = page1.gene_ddg_markdown_text(median_ddg, percentile)
 
+    timings["total"] = time.perf_counter() - start
+    if os.environ.get("dash_debug") == "True":
+        print(f"update_graphs_and_markdown({gene_selected}, {residual_selected}, {mutfrom_selected}, {mutto_selected}): "
+              + ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items()))
+
     return [gene_figure, variant_figure, text]
 
 
 @app.callback(Output('page-content', 'children'),
-              [Input('url', 'pathname')])
-def display_page(pathname):
+              [Input('url', 'pathname'),
+               Input('url', 'search')])
+def display_page(pathname, search):
     if pathname == '/' or pathname == '/page1':
-        return page1.layout
+        return page1.layout(data_registry.current())
+    elif pathname == '/admin/profiles' and token_valid(admin.search_token(search)):
+        return admin.layout()
     else:  # if redirected to unknown link
         return "404 Page Error! Please choose a link"
 
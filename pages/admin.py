@@ -0,0 +1,51 @@
+import os
+from urllib.parse import parse_qs, quote
+
+import dash_bootstrap_components as dbc
+from dash import html
+from flask import abort, request, send_from_directory
+
+from app import app
+import profiling
+
+
+# The ?token= value from a page's query string
+def search_token(search):
+    return parse_qs((search or "").lstrip("?")).get("token", [""])[0]
+
+
+# Serve the files written by profiling.py for the links on the admin page
+if profiling.admin_enabled:
+    @app.server.route("/admin/profiles/<path:name>")
+    def profile_file(name):
+        if not profiling.token_valid(request.args.get("token")):
+            abort(404)
+        return send_from_directory(os.path.abspath(profiling.profile_dir), name, mimetype="text/plain")
+
+
+# Layout, listing the newest slow-callback profiles first
+def layout():
+    if os.path.isdir(profiling.profile_dir):
+        names = sorted(os.listdir(profiling.profile_dir), reverse=True)
+    else:
+        names = []
+    reports = [name[:-len(".txt")] for name in names if name.endswith(".txt")]
+    token = quote(profiling.profile_token)
+
+    return dbc.Container([
+        html.Br(),
+        html.H1('Callback Profiles', className='text-center'),
+        html.Div(
+            f"Callbacks slower than {profiling.profile_threshold * 1000:.0f} ms are profiled into {profiling.profile_dir}.",
+            className='text-center mb-4',
+        ),
+        html.Ul([
+            html.Li([
+                f"{report} ",
+                html.A("report", href=f"/admin/profiles/{report}.txt?token={token}", target="_blank"),
+                " | ",
+                html.A("collapsed stacks", href=f"/admin/profiles/{report}.collapsed?token={token}", target="_blank"),
+            ])
+            for report in reports
+        ]),
+    ], fluid=True)
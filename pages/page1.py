@@ -1,282 +1,386 @@
+import os
+from bisect import bisect_left
+
 import dash_bootstrap_components as dbc
-from dash import html, dcc
-import plotly.express as px
+from dash import html, dcc, Patch
 import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
 
-import duckdb
-
-# Load static data files
-gene_pdbs = pd.read_csv("gene_pdbs")
-pdb_residual = pd.read_csv("pdb_residual")
-mutfrom_options = pd.read_csv("dropdown_pdb_mut_from.csv", dtype=str)
-mutto_options = pd.read_csv("dropdown_pdb_mut_from_to.csv", dtype=str)
-
-# Create in-memory DuckDB connection that queries CSVs directly
-duckdb_con = duckdb.connect(':memory:')
-
-# SAMPLE VERSION - Using only 2 CSV files for testing
-csv_files = [
-    'ddg_info/ddg_info1.csv',
-    'ddg_info/ddg_info2.csv',
-]
-
-# Create a view that unions all CSV files - DuckDB will read them on-demand
-union_query = " UNION ALL ".join([f"SELECT * FROM read_csv_auto('{csv}')" for csv in csv_files])
-duckdb_con.execute(f"CREATE VIEW ddg_info AS {union_query}")
-
-# Set memory limits to prevent OOM
-duckdb_con.execute("PRAGMA memory_limit='256MB'")
-duckdb_con.execute("PRAGMA threads=1")
-
-# Layout
-layout = dbc.Container([
-    html.Br(),
-    # Add banner to show this is sample data
-    dbc.Alert(
-        "⚠️ DEMO VERSION - This uses sample data (20% of full dataset) for testing. Full version coming soon!",
-        color="warning",
-        className="text-center mb-3"
-    ),
-    html.H1('Folding Energies', className='text-center'),
-    html.Div(
-        'Use the dropdowns below to select the gene and describe a variant.',
-        className='text-center mb-4',
-    ),
-
-    # Dropdowns
-    dbc.Row([
-        dbc.Col([
-            html.Div("Gene: "),
-            dcc.Dropdown(
-                options=[{'label': gene, 'value': gene} for gene in gene_pdbs['name_of_gene'].unique()],
-                id="gene_selected",
-                searchable=True,
-                placeholder="Select a gene...",
-                clearable=True
-            ),
-        ], width=3, className='mb-4'),
-
-        dbc.Col([
-            html.Div("Residual: "),
-            dcc.Dropdown(
-                id="residual_selected",
-                searchable=True,
-                placeholder="Select a residual...",
-                clearable=True
-            ),
-        ], width=3, className='mb-4'),
-
-        dbc.Col([
-            html.Div("Mutation From: "),
-            dcc.Dropdown(
-                id="mutfrom_selected",
-                searchable=True,
-                placeholder="Select mutation from...",
-                clearable=True
-            ),
-        ], width=3, className='mb-4'),
-
-        dbc.Col([
-            html.Div("Mutation To: "),
-            dcc.Dropdown(
-                id="mutto_selected",
-                searchable=True,
-                placeholder="Select mutation to...",
-                clearable=True
-            ),
-        ], width=3, className='mb-4'),
-    ]),
-
-    # Graphs
-    dbc.Row([
-        dbc.Col([
-            dcc.Loading(
-                id="loading-gene-ddg",
-                type="default",
-                children=dcc.Graph(id="gene_ddg"),
-                delay_show=200,
-                delay_hide=100,
-                show_initially=False,
-            ),
-        ], width=6, className='mb-4'),
-
-        dbc.Col([
-            dcc.Loading(
-                id="loading-variant-ddg",
-                type="default",
-                children=dcc.Graph(id="variant_ddg"),
-                delay_show=200,
-                delay_hide=100,
-                show_initially=False,
-            ),
-        ], width=6, className='mb-4'),
-    ]),
-
-    # Text
-    dbc.Row([
-        dbc.Col([
-            dcc.Markdown(
-                id='gene_ddg_markdown',
-                style={
-                    'width': '100%',
-                    'white-space': 'pre-line',
-                    'padding': '10px',
-                    'box-sizing': 'border-box',
-                    },
+from profiling import record_query
+
+# Percentiles are read from the merged per-PDB histograms, so changing the structure filters
+# only re-aggregates small arrays. approx_percentile=False counts them exactly instead, which
+# rescans every ΔΔG value of the selected structures on each change. Exact is also used when
+# the data version has no sketches
+approx_percentile = os.environ.get("approx_percentile", default="True") == "True"
+
+# Only the top matches for what has been typed into the gene and residue dropdowns are sent,
+# so the payload does not grow with the catalogue or the protein
+dropdown_limit = 50
+
+# Layout, built per request so the dropdown and filter options follow the current data version
+def layout(data):
+    return dbc.Container([
+        html.Br(),
+        html.H1('Folding Energies', className='text-center'),
+        html.Div(
+            'Use the dropdowns below to select the gene and describe a variant.',
+            className='text-center mb-4',
+        ),
+
+        # Dropdowns
+        dbc.Row([
+            dbc.Col([
+                html.Div("Gene: "),
+                dcc.Dropdown(
+                    options=[{'label': gene, 'value': gene} for gene in data.gene_index[:dropdown_limit]],
+                    id="gene_selected",
+                    searchable=True,
+                    placeholder="Select a gene...",
+                    clearable=True
                 ),
-        ], width=12, className='mb-4'),
-    ]),
-], fluid=True)
-
-
-def set_dropdown_options_page1_2a(gene_selected):
+            ], width=3, className='mb-4'),
+
+            dbc.Col([
+                html.Div("Residual: "),
+                dcc.Dropdown(
+                    id="residual_selected",
+                    searchable=True,
+                    placeholder="Select a residual...",
+                    clearable=True
+                ),
+            ], width=3, className='mb-4'),
+
+            dbc.Col([
+                html.Div("Mutation From: "),
+                dcc.Dropdown(
+                    id="mutfrom_selected",
+                    searchable=True,
+                    placeholder="Select mutation from...",
+                    clearable=True
+                ),
+            ], width=3, className='mb-4'),
+
+            dbc.Col([
+                html.Div("Mutation To: "),
+                dcc.Dropdown(
+                    id="mutto_selected",
+                    searchable=True,
+                    placeholder="Select mutation to...",
+                    clearable=True
+                ),
+            ], width=3, className='mb-4'),
+        ]),
+
+        # Structure filters
+        dbc.Row([
+            dbc.Col([
+                html.Div("Experimental methods: "),
+                dcc.Checklist(
+                    options=[{'label': method, 'value': method} for method in data.exp_method_options],
+                    value=data.exp_method_options,
+                    id="exp_method_selected",
+                    inline=True,
+                    inputStyle={'margin-right': '4px', 'margin-left': '12px'},
+                ),
+            ], width=6, className='mb-4'),
+
+            dbc.Col([
+                html.Div("Minimum coverage: "),
+                dcc.Slider(0, 1, 0.1, value=0, id="min_coverage"),
+            ], width=3, className='mb-4'),
+
+            dbc.Col([
+                html.Div("Minimum length: "),
+                dcc.Input(id="min_length", type="number", min=0, value=0, debounce=True),
+            ], width=3, className='mb-4'),
+        ]),
+
+        # Graphs
+        dbc.Row([
+            dbc.Col([
+                dcc.Loading(
+                    id="loading-gene-ddg",
+                    type="default",
+                    children=dcc.Graph(id="gene_ddg"),
+                    delay_show=200,
+                    delay_hide=100,
+                    show_initially=False,
+                ),
+            ], width=6, className='mb-4'),
+
+            dbc.Col([
+                dcc.Loading(
+                    id="loading-variant-ddg",
+                    type="default",
+                    children=dcc.Graph(id="variant_ddg"),
+                    delay_show=200,
+                    delay_hide=100,
+                    show_initially=False,
+                ),
+            ], width=6, className='mb-4'),
+        ]),
+
+        # Text
+        dbc.Row([
+            dbc.Col([
+                dcc.Markdown(
+                    id='gene_ddg_markdown',
+                    style={
+                        'width': '100%',
+                        'white-space': 'pre-line',
+                        'padding': '10px',
+                        'box-sizing': 'border-box',
+                        },
+                    ),
+            ], width=12, className='mb-4'),
+        ]),
+    ], fluid=True)
+
+
+# Genes starting with search_value, case-insensitively
+def search_genes(data, search_value):
+    if not search_value:
+        return data.gene_index[:dropdown_limit]
+    prefix = search_value.upper()
+    start = bisect_left(data.gene_index_keys, prefix)
+    end = bisect_left(data.gene_index_keys, prefix + '\uffff', lo=start)
+    return data.gene_index[start:min(end, start + dropdown_limit)]
+
+# Residues of a gene whose number starts with search_value, in numeric order. Numbers with a
+# given prefix and digit count form one contiguous range, e.g. "12" -> 12, 120-129, 1200-1299
+# and "-4" -> -4, -49 to -40, -499 to -400
+def search_residues(data, gene_selected, search_value):
+    residues = data.residue_index.get(gene_selected, [])
+    if not search_value:
+        return residues[:dropdown_limit]
+    negative = search_value.startswith('-')
+    digits = search_value[1:] if negative else search_value
+    # Residue numbers are written without leading zeros, so "01" or "-0" cannot match
+    leading_zero = digits.startswith('0') and (negative or digits != '0')
+    if not residues or (digits and not digits.isdigit()) or leading_zero:
+        return []
+    if not digits:
+        # Only "-" typed so far, offer the negative residues
+        return residues[:min(bisect_left(residues, 0), dropdown_limit)]
+    matches = []
+    low, high = int(digits), int(digits) + 1
+    largest = -residues[0] if negative else residues[-1]
+    while low <= largest and len(matches) < dropdown_limit:
+        if negative:
+            matches += residues[bisect_left(residues, 1 - high):bisect_left(residues, 1 - low)]
+        else:
+            matches += residues[bisect_left(residues, low):bisect_left(residues, high)]
+        if low == 0:
+            break
+        low, high = low * 10, high * 10
+    return matches[:dropdown_limit]
+
+def has_residue(data, gene_selected, residue):
+    residues = data.residue_index.get(gene_selected, [])
+    position = bisect_left(residues, residue)
+    return position < len(residues) and residues[position] == residue
+
+def set_dropdown_options_gene(data, search_value, gene_selected):
+    genes = search_genes(data, search_value)
+    # Keep the current selection in the options so the dropdown can still display it
+    if gene_selected and gene_selected not in genes:
+        genes = [gene_selected] + genes
+    return [{'label': gene, 'value': gene} for gene in genes]
+
+def set_dropdown_options_page1_2a(data, gene_selected, search_value=None, residual_selected=None):
     if gene_selected:
-        pdb_residual_values = pdb_residual[gene_selected].dropna().astype(int).tolist()
+        pdb_residual_values = search_residues(data, gene_selected, search_value)
+        # Keep the current residue displayed, unless it belongs to a previously selected gene.
+        # Leaving it out of the options lets the dropdown clear it, which resets the mutations
+        if (residual_selected is not None and residual_selected not in pdb_residual_values
+                and has_residue(data, gene_selected, residual_selected)):
+            pdb_residual_values = [residual_selected] + pdb_residual_values
         return [{'label': str(residual), 'value': residual} for residual in pdb_residual_values]
     return []
 
 
-def set_dropdown_options_page1_2b(gene_selected,residual_selected):
-    if gene_selected and residual_selected:
-        column = f"{gene_selected}-{residual_selected}"
-        mutfrom_values = mutfrom_options[column].dropna().tolist()
+def set_dropdown_options_page1_2b(data, gene_selected, residual_selected):
+    column = f"{gene_selected}-{residual_selected}"
+    # The residue can still be the previous gene's until its dropdown has been cleared
+    if gene_selected and residual_selected and column in data.mutfrom_options:
+        mutfrom_values = data.mutfrom_options[column].dropna().tolist()
         return [{'label': str(mutfrom), 'value': mutfrom} for mutfrom in mutfrom_values]
     return []
         
 
-def set_dropdown_options_page1_2c(gene_selected, residual_selected, mutfrom_selected):
-    if gene_selected and residual_selected and mutfrom_selected:
-        column = f"{gene_selected}-{residual_selected}-{mutfrom_selected}"
-        mutto_values = mutto_options[column].dropna().tolist()
+def set_dropdown_options_page1_2c(data, gene_selected, residual_selected, mutfrom_selected):
+    column = f"{gene_selected}-{residual_selected}-{mutfrom_selected}"
+    if gene_selected and residual_selected and mutfrom_selected and column in data.mutto_options:
+        mutto_values = data.mutto_options[column].dropna().tolist()
         return [{'label': str(mutto), 'value': mutto} for mutto in mutto_values]
     return []
 
 
-def get_pdb_values(gene_pdbs, gene_selected):
-    filtered_gene_pdbs = gene_pdbs[gene_pdbs['name_of_gene'] == gene_selected]
+def get_pdb_values(data, gene_selected, exp_method_selected=None, min_coverage=None, min_length=None):
+    filtered_gene_pdbs = data.gene_pdbs[data.gene_pdbs['name_of_gene'] == gene_selected]
+    # Structures without a recorded method are only dropped once the method filter is narrowed
+    if exp_method_selected is not None and set(exp_method_selected) != set(data.exp_method_options):
+        filtered_gene_pdbs = filtered_gene_pdbs[filtered_gene_pdbs['exp_method'].isin(exp_method_selected)]
+    if min_coverage:
+        filtered_gene_pdbs = filtered_gene_pdbs[filtered_gene_pdbs['coverage'] >= min_coverage]
+    if min_length:
+        filtered_gene_pdbs = filtered_gene_pdbs[filtered_gene_pdbs['length'] >= min_length]
     pdb_values = filtered_gene_pdbs['pdb'].unique().tolist()
     return pdb_values
 
-# Calculate median of the variant histogram
-def calculate_median(pdb_values, residual_selected, mutfrom_selected, mutto_selected):
-    if mutfrom_selected is None or mutto_selected is None:
-        return None
-    pdb_values_str = ', '.join(f"'{pdb}'" for pdb in pdb_values)
+# Run a query on its own cursor so callbacks can query DuckDB from several threads at once
+def run_query(data, query, parameters=None):
+    record_query(data.duckdb_con, query, parameters)
+    with data.duckdb_con.cursor() as cursor:
+        result = cursor.execute(query, parameters)
+        return result.fetchdf()
+
+# ΔΔG values for the selected variant across every structure of the gene
+def get_variant_ddg(data, pdb_values, residual_selected, mutfrom_selected, mutto_selected):
+    pdb_placeholders = ', '.join('?' * len(pdb_values))
     query = f"""
         SELECT ddg
         FROM ddg_info
-        WHERE pdb IN ({pdb_values_str})
-        AND pdb_residual = '{residual_selected}'
-        AND mut_from = '{mutfrom_selected}'
-        AND mut_to = '{mutto_selected}'
+        WHERE pdb IN ({pdb_placeholders})
+        AND pdb_residual = ?
+        AND mut_from = ?
+        AND mut_to = ?
     """
-    filtered_ddg_info = duckdb_con.execute(query).fetchdf()
-    median_ddg = filtered_ddg_info['ddg'].median()
+    # Values from the client are bound as parameters, never formatted into the SQL
+    parameters = pdb_values + [str(residual_selected), mutfrom_selected, mutto_selected]
+    return run_query(data, query, parameters)
+
+# Calculate median of the variant histogram
+def calculate_median(variant_ddg):
+    median_ddg = variant_ddg['ddg'].median()
     return median_ddg
 
-def ddg_for_gene_plot(gene_selected, pdb_values, median_ddg):
-    pdb_values_str = ', '.join(f"'{pdb}'" for pdb in pdb_values)
+# Fixed ΔΔG bins for the gene histogram, covering the visible x range
+gene_bin_edges = np.linspace(-10, 100, 1001)
+gene_bin_centres = (gene_bin_edges[:-1] + gene_bin_edges[1:]) / 2
+variant_nbins = 20
+
+# Build a base histogram as a plain dict. Requests only patch the bar data, title and
+# median marker into it, so the template and static layout are sent to the browser once
+def histogram_base(title, bin_centres, bin_width):
+    figure = go.Figure(
+        go.Bar(
+            x=bin_centres,
+            y=[0] * len(bin_centres),
+            width=bin_width,
+            marker_line_width=0,
+            hovertemplate='ΔΔG (kcal/mol)=%{x:.2f}<br>count=%{y}<extra></extra>',
+        ),
+        layout=dict(
+            title=title,
+            template="plotly_white",
+            bargap=0,
+            xaxis=dict(range=[-10, 100], showgrid=False, title="ΔΔG (kcal/mol)"),
+            yaxis=dict(showticklabels=False, title="Frequency"),
+            # Median marker, hidden until a variant is selected
+            shapes=[dict(
+                type="line", visible=False, x0=0, x1=0, y0=0, y1=1, xref="x", yref="paper",
+                line=dict(color="Red", width=2),
+            )],
+            annotations=[dict(
+                visible=False, x=0, y=1, xref="x", yref="paper", text="",
+                showarrow=True, arrowhead=2,
+            )],
+        ),
+    )
+    return figure.to_dict()
+
+empty_gene_histogram = histogram_base(
+    'Histogram of ΔΔG values for selected gene',
+    gene_bin_centres.tolist(),
+    gene_bin_edges[1] - gene_bin_edges[0],
+)
+empty_variant_histogram = histogram_base(
+    'Histogram of ΔΔG values for selected variant',
+    [],
+    None,
+)
+
+# Gene histogram counts binned inside DuckDB, for when the per-PDB sketches are not
+# available. Bins match create_parquet.py, and at most 1000 rows leave the query
+def get_gene_histogram(data, pdb_values):
+    pdb_placeholders = ', '.join('?' * len(pdb_values))
     query = f"""
-        SELECT *
+        SELECT LEAST(CAST(floor((ddg + 10) / 0.11) AS INTEGER), 999) AS bin, count(*) AS n
         FROM ddg_info
-        WHERE pdb IN ({pdb_values_str})
+        WHERE pdb IN ({pdb_placeholders})
+        AND ddg >= -10 AND ddg < 100
+        GROUP BY bin
     """
-    filtered_ddg_info = duckdb_con.execute(query).fetchdf()
-
-    figure = px.histogram(
-        filtered_ddg_info,
-        x='ddg',
-        range_x=[-10, 100],
-        nbins=1000, 
-        title=f'Histogram of ΔΔG values for {gene_selected}', 
-        labels={'ddg': 'ΔΔG (kcal/mol)'},
-        template="plotly_white",
-    )
-    figure.update_yaxes(showticklabels=False, title="Frequency")
-
-    if median_ddg is not None:
-        figure.add_shape(
-            go.layout.Shape(
-                type="line",
-                x0=median_ddg,
-                x1=median_ddg,
-                y0=0,
-                y1=1,
-                xref="x",
-                yref="paper",
-                line=dict(
-                    color="Red",
-                    width=2
-                )
-            )
-        )
-        figure.add_annotation(
-            go.layout.Annotation(
-                x=median_ddg,
-                y=1,
-                xref="x", 
-                yref="paper",
-                text=f'Variant median: {median_ddg:.2f} kcal/mol',
-                showarrow=True,
-                arrowhead=2
-            )
-        )
+    histogram = run_query(data, query, pdb_values)
+    counts = np.zeros(len(gene_bin_centres), dtype=np.int64)
+    counts[histogram['bin'].values] = histogram['n'].values
+    return counts
+
+def ddg_for_gene_plot(gene_selected, gene_counts, median_ddg):
+    figure = Patch()
+    figure['data'][0]['y'] = gene_counts.tolist()
+    figure['layout']['title']['text'] = f'Histogram of ΔΔG values for {gene_selected}'
+
+    show_median = median_ddg is not None and not pd.isna(median_ddg)
+    figure['layout']['shapes'][0]['visible'] = show_median
+    figure['layout']['annotations'][0]['visible'] = show_median
+    if show_median:
+        figure['layout']['shapes'][0]['x0'] = median_ddg
+        figure['layout']['shapes'][0]['x1'] = median_ddg
+        figure['layout']['annotations'][0]['x'] = median_ddg
+        figure['layout']['annotations'][0]['text'] = f'Variant median: {median_ddg:.2f} kcal/mol'
 
     return figure
 
-def ddg_for_variant_plot(pdb_values, residual_selected, mutfrom_selected, mutto_selected):
-    pdb_values_str = ', '.join(f"'{pdb}'" for pdb in pdb_values)
-    query = f"""
-        SELECT *
-        FROM ddg_info
-        WHERE pdb IN ({pdb_values_str})
-        AND pdb_residual = '{residual_selected}'
-        AND mut_from = '{mutfrom_selected}'
-        AND mut_to = '{mutto_selected}'
-    """
-    filtered_ddg_info_var3 = duckdb_con.execute(query).fetchdf()
-
-    # Create the histogram
-    figure = px.histogram(
-        filtered_ddg_info_var3, x='ddg',
-        range_x=[-10, 100],
-        nbins=20,
-        title='Histogram of ΔΔG values for selected variant',
-        labels={'ddg': 'ΔΔG (kcal/mol)'},
-        template="plotly_white",
-    )
-    figure.update_yaxes(showticklabels=False, title="Frequency")
+def ddg_for_variant_plot(variant_ddg):
+    # Bin over the range of the variant's values, as the Plotly histogram did
+    counts, edges = np.histogram(variant_ddg['ddg'].dropna().values, bins=variant_nbins)
+
+    figure = Patch()
+    figure['data'][0]['x'] = ((edges[:-1] + edges[1:]) / 2).tolist()
+    figure['data'][0]['y'] = counts.tolist()
+    figure['data'][0]['width'] = float(edges[1] - edges[0])
     return figure
 
 
 ##Callback for markdown text
-def calculate_percentile(pdb_values, residual_selected, mutfrom_selected, mutto_selected):
-    pdb_values_str = ', '.join(f"'{pdb}'" for pdb in pdb_values)
-    query_all = f"""
-        SELECT ddg
-        FROM ddg_info
-        WHERE pdb IN ({pdb_values_str})
-    """
-    # Execute the query and fetch the results
-    filtered_ddg_info_all = duckdb_con.execute(query_all).fetchdf()
-    values = filtered_ddg_info_all['ddg'].values
-
-    query_variant = f"""
-        SELECT ddg
+# Exact percentile counted inside DuckDB, so only one number leaves the query. Missing ΔΔG
+# values are left out of the total, as they are from the per-PDB sketches
+def calculate_percentile(data, pdb_values, median_ddg):
+    pdb_placeholders = ', '.join('?' * len(pdb_values))
+    query = f"""
+        SELECT count(*) FILTER (WHERE ddg < ?) * 100.0 / nullif(count(ddg), 0) AS percentile
         FROM ddg_info
-        WHERE pdb IN ({pdb_values_str})
-        AND pdb_residual = '{residual_selected}'
-        AND mut_from = '{mutfrom_selected}'
-        AND mut_to = '{mutto_selected}'
+        WHERE pdb IN ({pdb_placeholders})
     """
-    filtered_ddg_info_var3 = duckdb_con.execute(query_variant).fetchdf()
-    median_ddg = filtered_ddg_info_var3['ddg'].median()
-
-    percentile = np.sum(values < median_ddg) / len(values) * 100
+    percentile = run_query(data, query, [float(median_ddg)] + pdb_values)['percentile'].iloc[0]
     return percentile
 
+# Merge the sketches of a gene's structures into one histogram. Bins 1-1000 are the gene
+# histogram counts. Sketches are per PDB, so a change to the gene_pdbs mapping or the
+# structure filters only changes which rows are summed
+def get_gene_sketch(data, pdb_values):
+    rows = [data.pdb_sketch_rows[pdb] for pdb in pdb_values if pdb in data.pdb_sketch_rows]
+    return data.pdb_sketches[rows].sum(axis=0)
+
+# Percentile of median_ddg from a merged sketch, interpolating linearly within its bin.
+# The error is at most the share of the gene's values in that bin, i.e. the result is exact
+# to within one 0.11 kcal/mol bin (half the under/overflow bin if outside -10..100)
+def calculate_approx_percentile(gene_sketch, median_ddg):
+    total = gene_sketch.sum()
+    if total == 0 or pd.isna(median_ddg):
+        return np.nan
+    median_bin = np.searchsorted(gene_bin_edges, median_ddg, side='right')
+    if 0 < median_bin < len(gene_bin_edges):
+        fraction = (median_ddg - gene_bin_edges[median_bin - 1]) / (gene_bin_edges[median_bin] - gene_bin_edges[median_bin - 1])
+    else:
+        fraction = 0.5
+    below = gene_sketch[:median_bin].sum() + gene_sketch[median_bin] * fraction
+    return below / total * 100
+
 def gene_ddg_markdown_text(median_ddg, percentile):
     
     Serrano = "[Serrano](https://www.crg.eu/luis_serrano)"
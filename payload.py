@@ -0,0 +1,8 @@
+import os
+
+# Largest uncompressed callback response we aim to send, in bytes. Responses over it are
+# logged by the after_request hook in app.py
+payload_budget = int(os.environ.get("payload_budget_kb", default="256")) * 1024
+
+def payload_size_message(name, size):
+    return f"{name} is {size / 1024:.0f} KB, over the {payload_budget // 1024} KB payload budget"
@@ -0,0 +1,138 @@
+import collections
+import contextvars
+import functools
+import hmac
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Opt-in profiling of slow callbacks. When dash_profile is True every profiled callback is
+# sample-profiled, and any call slower than profile_threshold_ms leaves two files in
+# profile_dir: <stamp>-<callback>.collapsed, collapsed stacks for flamegraph.pl or
+# speedscope, and <stamp>-<callback>.txt, the call's arguments and timings with
+# EXPLAIN ANALYZE for every DuckDB query it ran. Both are listed on /admin/profiles
+profile_enabled = os.environ.get("dash_profile", default="False") == "True"
+profile_threshold = float(os.environ.get("profile_threshold_ms", default="500")) / 1000
+profile_interval = float(os.environ.get("profile_interval_ms", default="5")) / 1000
+profile_dir = os.environ.get("profile_dir", default="profiles")
+
+# Profiles hold request arguments and query plans, so /admin/profiles is only served when
+# profiling is on and profile_token is set, and every request must pass it as ?token=
+profile_token = os.environ.get("profile_token", default="")
+admin_enabled = profile_enabled and bool(profile_token)
+
+def token_valid(token):
+    return admin_enabled and hmac.compare_digest(token or "", profile_token)
+
+active_profile = contextvars.ContextVar("active_profile", default=None)
+
+
+# One stack as "outermost;...;innermost" with the line being run in each frame, so time in
+# DuckDB's execute can be told apart from fetchdf on the next line
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class Profile:
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.threads = {threading.get_ident()}
+        self.stacks = collections.Counter()
+        self.queries = []
+        self.done = threading.Event()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.done.wait(profile_interval):
+            frames = sys._current_frames()
+            for ident in list(self.threads):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started
+        self.done.set()
+        self.sampler.join()
+
+    def write(self):
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{self.name}")
+
+        with open(f"{path}.collapsed", 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        with open(f"{path}.txt", 'w') as f:
+            f.write(f"{self.name}{self.args}\n")
+            f.write(f"took {self.duration * 1000:.1f} ms, {sum(self.stacks.values())} samples "
+                    f"every {profile_interval * 1000:.0f} ms\n")
+            for duckdb_con, query, parameters in self.queries:
+                f.write(f"\n{'-' * 80}\n{query.strip()}\n")
+                if parameters:
+                    f.write(f"parameters: {parameters}\n")
+                f.write("\n")
+                try:
+                    with duckdb_con.cursor() as cursor:
+                        plan = cursor.execute(f"EXPLAIN ANALYZE {query}", parameters).fetchall()
+                    f.write("\n".join(row[-1] for row in plan) + "\n")
+                except Exception as error:
+                    f.write(f"EXPLAIN ANALYZE failed: {error}\n")
+
+
+# Profile a callback. Applied below @app.callback, and a no-op unless dash_profile is True
+def profiled(callback):
+    if not profile_enabled:
+        return callback
+
+    @functools.wraps(callback)
+    def wrapper(*args):
+        profile = Profile(callback.__name__, args)
+        token = active_profile.set(profile)
+        profile.start()
+        try:
+            return callback(*args)
+        finally:
+            profile.stop()
+            active_profile.reset(token)
+            # EXPLAIN ANALYZE reruns the queries, so write outside the request
+            if profile.duration >= profile_threshold:
+                threading.Thread(target=profile.write, daemon=True).start()
+
+    return wrapper
+
+
+# Sample the calling thread too while the block runs. Work handed to a thread pool should be
+# run in a copy of the caller's context (contextvars.copy_context().run) so it finds the profile
+@contextmanager
+def profile_thread():
+    profile = active_profile.get()
+    ident = threading.get_ident()
+    if profile is None or ident in profile.threads:
+        yield
+        return
+    profile.threads.add(ident)
+    try:
+        yield
+    finally:
+        profile.threads.discard(ident)
+
+
+# Remember a query so a slow call's report can include its EXPLAIN ANALYZE
+def record_query(duckdb_con, query, parameters=None):
+    profile = active_profile.get()
+    if profile is not None:
+        profile.queries.append((duckdb_con, query, parameters))
@@ -0,0 +1,42 @@
+import json
+import os
+import shutil
+import sys
+from datetime import datetime, timezone
+
+from data_registry import file_hash, local_files, manifest_file
+
+# Publish the data files in the working directory as a new data version. Each file is
+# copied into data/objects/<sha256>/, which is never modified afterwards, and the manifest
+# is then replaced in one rename. Running workers pick the new version up without a restart.
+#   python publish_data.py [version]
+version = sys.argv[1] if len(sys.argv) > 1 else datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+root = os.path.dirname(manifest_file)
+
+files = {}
+for name, source in local_files.items():
+    if not os.path.exists(source):
+        print(f"Skipping {name}: {source} not found")
+        continue
+    digest = file_hash(source)
+    target = os.path.join("objects", digest)
+    if not os.path.exists(os.path.join(root, target)):
+        # Copy into a staging directory first so a half-copied object is never visible
+        staging = os.path.join(root, "objects", f"{digest}.tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(staging, os.path.basename(source)))
+        else:
+            shutil.copy2(source, staging)
+        # The only hash check: workers trust objects/<sha256>/ from here on
+        if file_hash(os.path.join(staging, os.path.basename(source))) != digest:
+            raise ValueError(f"{source} changed while it was being published")
+        os.replace(staging, os.path.join(root, target))
+    files[name] = {"path": os.path.join(target, os.path.basename(source)), "sha256": digest}
+
+manifest_tmp = f"{manifest_file}.tmp"
+with open(manifest_tmp, 'w') as f:
+    json.dump({"version": version, "files": files}, f, indent=2)
+os.replace(manifest_tmp, manifest_file)
+print(f"Published data version {version} to {manifest_file}")